@@ -298,7 +298,25 @@ class Glow(nn.Module):
         x = self.flow(z, temperature=temperature, reverse=True)
         return x
 
+    def init_actnorm_streaming(self, x, y_onehot=None):
+        """
+        Pools the batch `x` into the data-dependent ActNorm initialization.
+        Call once per initialization batch and finish with set_actnorm_init();
+        layers that were marked as initialized without seeing data (e.g.
+        loaded weights) are left alone.
+
+        This approximates initializing on all batches at once: only the first
+        ActNorm sees exactly the same inputs, later layers pool statistics of
+        batches that passed through different upstream parameters.
+        """
+        for name, m in self.named_modules():
+            if isinstance(m, ActNorm2d) and m.init_count > 0:
+                m.inited = False
+
+        return self(x, y_onehot)
+
     def set_actnorm_init(self):
         for name, m in self.named_modules():
             if isinstance(m, ActNorm2d):
                 m.inited = True
+                m.reset_init_stats()
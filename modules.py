@@ -79,14 +79,42 @@ class _ActNorm(nn.Module):
         self.num_features = num_features
         self.scale = scale
         self.inited = False
+        # per-channel statistics of the batches seen during initialization,
+        # kept out of the state dict and cleared by reset_init_stats()
+        self.init_count = 0
+        self.register_buffer("init_mean", None, persistent=False)
+        self.register_buffer("init_m2", None, persistent=False)
 
     def initialize_parameters(self, input):
+        """
+        Statistics of `input` are pooled with those of earlier calls,
+        so the initialization can be streamed over several batches.
+
+        When streaming through a network, the earlier batches reached this
+        layer through upstream layers whose parameters have changed since,
+        so for all but the first layer the pooled statistics approximate
+        those of a single pass over all batches.
+        """
         if not self.training:
             raise ValueError("In Eval mode, but ActNorm not inited")
 
         with torch.no_grad():
-            bias = -torch.mean(input.clone(), dim=[0, 2, 3], keepdim=True)
-            vars = torch.mean((input.clone() + bias) ** 2, dim=[0, 2, 3], keepdim=True)
+            count = input.numel() // input.size(1)
+            mean = torch.mean(input, dim=[0, 2, 3], keepdim=True)
+            m2 = torch.sum((input - mean) ** 2, dim=[0, 2, 3], keepdim=True)
+
+            if self.init_count > 0:
+                # parallel variance update (Chan et al.)
+                total = self.init_count + count
+                delta = mean - self.init_mean
+                mean = self.init_mean + delta * count / total
+                m2 = self.init_m2 + m2 + delta ** 2 * self.init_count * count / total
+                count = total
+
+            self.init_count, self.init_mean, self.init_m2 = count, mean, m2
+
+            bias = -mean
+            vars = m2 / count
             logs = torch.log(self.scale / (torch.sqrt(vars) + 1e-4))
 
             self.bias.data.copy_(bias.data)
@@ -94,6 +122,11 @@ class _ActNorm(nn.Module):
 
             self.inited = True
 
+    def reset_init_stats(self):
+        self.init_count = 0
+        self.init_mean = None
+        self.init_m2 = None
+
     def _center(self, input, reverse=False):
         if reverse:
             return input - self.bias
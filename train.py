@@ -39,6 +39,11 @@ def check_dataset(dataset, dataroot, augment, download):
     return input_size, num_classes, train_dataset, test_dataset
 
 
+def collate_images(batch):
+    # labels are only used with y_condition, so don't collate them otherwise
+    return data.default_collate([x for x, _ in batch]), None
+
+
 def compute_loss(nll, reduction="mean"):
     if reduction == "mean":
         losses = {"nll": torch.mean(nll)}
@@ -78,53 +83,115 @@ def makeScaleMatrix(num_gen, num_orig, device='cpu'):
         # 50 is batch size but hardcoded
         return torch.cat([s1, s2], dim=0)
 
-# before we had: sigma = [2, 5, 10, 20, 40, 80]
-def compute_loss_energy(x, gen_x, sigma = [2, 5, 10, 20, 40, 80], reduction='mean', device='cpu'):
+# scale matrices used by compute_loss_energy, keyed on
+# (num_gen, num_orig, dtype, device)
+_S_CACHE = {}
+# flat indices of the strictly upper triangle, the scale factors at those
+# indices and the trace of the scale matrix, keyed like _S_CACHE
+_TRIU_CACHE = {}
+# per-bandwidth factors -0.5 / (sqrt(d) * sigma) applied to the squared
+# distances, keyed on (sigma, d, dtype, device)
+_KERNEL_SCALE_CACHE = {}
+
+
+def _cached(cache, key, build):
+    value = cache.get(key)
+    if value is None:
+        value = _build_cached(build)
+        cache[key] = value
+    return value
+
+
+@torch.compiler.disable
+def _build_cached(build):
+    # runs eagerly so a compiled, CUDA-graphed caller doesn't keep tensors
+    # from its graph memory pool in the cache; cached tensors are also shared
+    # with training, so they must not be created as inference tensors
+    with torch.inference_mode(False):
+        return build()
+
+
+def _scale_matrix(num_gen, num_orig, dtype, device):
+    # scaling constants for each of the rows in 'X'
+    s = makeScaleMatrix(num_gen, num_orig, device=device)
+    return (s @ s.T).to(dtype)
+
+
+def _triu_scales(S, device):
+    n = S.shape[0]
+    rows, cols = torch.triu_indices(n, n, offset=1, device=device)
+    idx = rows * n + cols
+    return idx, S.flatten()[idx], torch.trace(S)
+
+
+# kernel bandwidths used by compute_loss_energy when none are given
+_DEFAULT_SIGMAS = (2.0, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+def compute_loss_energy(x, gen_x, sigma=None, reduction='mean', device='cpu'):
+        if sigma is None:
+            sigma = _DEFAULT_SIGMAS
         # concatenation of the generated images and images from the dataset
         # first 'N' rows are the generated ones, next 'M' are from the data
         X = torch.cat([gen_x, x], dim=0)
-        # dot product between all combinations of rows in 'X'
 
         # TODO: should we handle all channels together or separately?
         # currently we're comparing every channel to every channel
         X = X.flatten(1)
         d = X.shape[1]
 
-        XX = torch.matmul(X, torch.transpose(X, 0, 1))
         # dot product of rows with themselves
-        X2 = torch.sum(X * X, dim = 1, keepdim=True)
-        # exponent entries of the RBF kernel (without the sigma) for each
-        # combination of the rows in 'X'
-        # -0.5 * (x^Tx - 2*x^Ty + y^Ty)
-        exponent = XX - 0.5 * X2 - 0.5 * torch.transpose(X2, 0, 1)
-        # TODO: unclear if needed, doesn't remove NaNs by itself
-        exponent = exponent / sqrt(d)
-        # TODO: unclear if needed, doesn't remove NaNs & could hurt perf
-        exponent = torch.clip(exponent, -1e4, 1e4)
-        # scaling constants for each of the rows in 'X'
-        s = makeScaleMatrix(gen_x.shape[0], x.shape[0], device=device)
+        X2 = torch.sum(X * X, dim=1, keepdim=True)
+        # squared distances between all combinations of rows in 'X',
+        # x^Tx - 2*x^Ty + y^Ty, with the cross term fused into a single GEMM;
+        # X is contiguous, so X.T is a transposed GEMM operand rather than a copy
+        D2 = torch.addmm(X2 + X2.T, X, X.T, alpha=-2.0)
         # scaling factors of each of the kernel values, corresponding to the
-        # exponent values
-        S = torch.matmul(s, torch.transpose(s, 0, 1))
-        loss = 0
-        # for each bandwidth parameter, compute the MMD value and add them all
-        for i in range(len(sigma)):
-            # kernel values for each combination of the rows in 'X'
-            v = 1.0 / sigma[i] * exponent
-            # v = torch.clip(v, -1e3, -1e3) # doesnt solve NaNs by itself
-            kernel_val = torch.exp(v)
-            loss += torch.sum(S * kernel_val, axis=1)
-
-        if reduction == 'mean':
-            final_loss = torch.mean(loss, axis=0)
-        elif reduction == 'sum':
-            final_loss = torch.sum(loss, axis=0)
-        elif reduction == 'none':
-            final_loss = loss
+        # squared distances; only depends on the batch sizes, so build it once
+        key = (gen_x.shape[0], x.shape[0], X.dtype, str(device))
+        S = _cached(
+            _S_CACHE,
+            key,
+            lambda: _scale_matrix(gen_x.shape[0], x.shape[0], X.dtype, device),
+        )
+        # exponent of the RBF kernel for each bandwidth is -0.5 * D2 / sigma,
+        # scaled by 1 / sqrt(d); the constants are folded into one factor per
+        # bandwidth so they cost nothing on top of the batched exp
+        # TODO: unclear if the sqrt(d) scaling is needed, doesn't remove NaNs
+        sigma_key = (tuple(sigma), d, X.dtype, str(device))
+        kernel_scale = _cached(
+            _KERNEL_SCALE_CACHE,
+            sigma_key,
+            lambda: torch.tensor(
+                [-0.5 / (sqrt(d) * s) for s in sigma], dtype=X.dtype, device=device
+            ),
+        )
+
+        if reduction == 'none':
+            # the per-row MMD values need the full kernel matrix
+            kernel_vals = torch.exp(D2.unsqueeze(0) * kernel_scale.view(-1, 1, 1))
+            # compute the MMD value for each bandwidth and add them all; kept
+            # as an elementwise product and sum, which autocast leaves in fp32
+            final_loss = torch.sum(S.unsqueeze(0) * kernel_vals, dim=(0, 2))
+        elif reduction in ('mean', 'sum'):
+            idx, S_triu, S_trace = _cached(
+                _TRIU_CACHE, key, lambda: _triu_scales(S, device)
+            )
+            # the kernel matrix is symmetric with ones on the diagonal (zero
+            # distance), so only the strictly upper triangle is exponentiated
+            kernel_vals = torch.exp(D2.flatten()[idx].unsqueeze(0) * kernel_scale.view(-1, 1))
+            # compute the MMD value for each bandwidth and add them all; the
+            # weighted sum cancels against the trace term, so it is kept as an
+            # elementwise product and sum, which autocast leaves in fp32
+            final_loss = len(sigma) * S_trace + 2 * torch.sum(S_triu * kernel_vals)
+            if reduction == 'mean':
+                final_loss = final_loss / S.shape[0]
         else:
             raise ValueError()
         # TODO: this is a strange place to take sqrt
-        final_loss = torch.sqrt(final_loss+1e-5)
+        # 'mean'/'sum' are s^T K s for a PSD sum of Gaussian kernels, so they
+        # are nonnegative up to rounding; per-row values from reduction='none'
+        # can be genuinely negative, which would make the sqrt NaN
+        final_loss = torch.sqrt(final_loss.clamp(min=0) + 1e-5)
         return final_loss
 
 
@@ -157,10 +224,27 @@ def main(
     output_dir,
     saved_optimizer,
     warmup,
+    channels_last,
+    precision,
+    compile_model,
+    loss_type,
 ):
 
     device = "cpu" if (not torch.cuda.is_available() or not cuda) else "cuda:0"
 
+    if device != "cpu":
+        # input shapes are fixed, so let cuDNN pick the fastest conv algorithms
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    if precision == "fp16" and device == "cpu":
+        raise ValueError(
+            "fp16 training needs CUDA for loss scaling, use --precision bf16 on CPU"
+        )
+
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
     check_manual_seed(seed)
 
     ds = check_dataset(dataset, dataroot, augment, download)
@@ -169,19 +253,34 @@ def main(
     # Note: unsupported for now
     multi_class = False
 
+    if n_workers is None:
+        n_workers = min(max((os.cpu_count() or 1) - 2, 1), 8)
+        print("Using {n_workers} data loading workers".format(n_workers=n_workers))
+
+    # pinned host memory lets the .to(device, non_blocking=True) copies
+    # in step/eval_step overlap with compute
+    loader_kwargs = {
+        "num_workers": n_workers,
+        "pin_memory": device != "cpu",
+        "persistent_workers": n_workers > 0,
+        "collate_fn": None if y_condition else collate_images,
+    }
+    if n_workers > 0:
+        loader_kwargs["prefetch_factor"] = 4
+
     train_loader = data.DataLoader(
         train_dataset,
         batch_size=batch_size,
         shuffle=True,
-        num_workers=n_workers,
         drop_last=True,
+        **loader_kwargs,
     )
     test_loader = data.DataLoader(
         test_dataset,
         batch_size=eval_batch_size,
         shuffle=False,
-        num_workers=n_workers,
         drop_last=False,
+        **loader_kwargs,
     )
 
     model = Glow(
@@ -198,39 +297,76 @@ def main(
         y_condition,
     )
 
-    model = model.to(device)
+    model = model.to(device, memory_format=memory_format)
+
+    # the compiled wrappers share parameters with `model`, which stays eager
+    # for actnorm init, checkpointing and loading state dicts
+    if compile_model:
+        model_fn = torch.compile(model, mode="max-autotune")
+        loss_energy_fn = torch.compile(
+            compute_loss_energy, mode="max-autotune", dynamic=False
+        )
+    else:
+        model_fn = model
+        loss_energy_fn = compute_loss_energy
+
     optimizer = optim.Adamax(model.parameters(), lr=lr, weight_decay=5e-5)
 
+    # mixed precision: fp16 needs loss scaling to avoid gradient underflow,
+    # bf16 has the fp32 exponent range and runs without a scaler
+    autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+    scaler = torch.amp.GradScaler("cuda", enabled=precision == "fp16")
+
+    device_type = "cpu" if device == "cpu" else "cuda"
+
+    def autocast():
+        return torch.autocast(
+            device_type=device_type,
+            dtype=autocast_dtype,
+            enabled=autocast_dtype is not None,
+        )
+
+    def fp32_loss_energy(x, x_pred, **kwargs):
+        # the squared distances in the MMD cancel large terms, so the loss
+        # always runs in fp32, even when the model forward uses autocast
+        with torch.autocast(device_type=device_type, enabled=False):
+            return loss_energy_fn(x.float(), x_pred.float(), device=device, **kwargs)
+
     lr_lambda = lambda epoch: min(1.0, (epoch + 1) / warmup)  # noqa
     scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lr_lambda)
 
     def step(engine, batch):
         model.train()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
         x, y = batch
-        x = x.to(device)
+        x = x.to(device, non_blocking=True, memory_format=memory_format)
 
-        if y_condition:
-            y = y.to(device)
-            z, nll, y_logits = model(x, y)
-            losses = compute_loss_y(nll, y_logits, y_weight, y, multi_class)
-        else:
-            # z, nll, y_logits = model(x, None)
-            # losses = compute_loss(nll)
-            # TODO: might want to have a temperature warmup step
-            x_pred = model(x=None, y_onehot=None, z=None, temperature=3e-1, reverse=True)
-            loss_energy = compute_loss_energy(x, x_pred, device=device)
-            losses = {"total_loss": loss_energy, "loss_energy": loss_energy}ff
+        with autocast():
+            if y_condition:
+                y = y.to(device, non_blocking=True)
+                z, nll, y_logits = model_fn(x, y)
+                losses = compute_loss_y(nll, y_logits, y_weight, y, multi_class)
+            elif loss_type == "nll":
+                z, nll, y_logits = model_fn(x, None)
+                losses = compute_loss(nll)
+            else:
+                # TODO: might want to have a temperature warmup step
+                x_pred = model_fn(x=None, y_onehot=None, z=None, temperature=3e-1, reverse=True)
+                loss_energy = fp32_loss_energy(x, x_pred)
+                losses = {"total_loss": loss_energy, "loss_energy": loss_energy}
 
-        losses["total_loss"].backward()
+        scaler.scale(losses["total_loss"]).backward()
 
+        # gradients have to be unscaled before clipping
+        scaler.unscale_(optimizer)
         if max_grad_clip > 0:
             torch.nn.utils.clip_grad_value_(model.parameters(), max_grad_clip)
         if max_grad_norm > 0:
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
 
         return losses
 
@@ -238,21 +374,22 @@ def main(
         model.eval()
 
         x, y = batch
-        x = x.to(device)
+        x = x.to(device, non_blocking=True, memory_format=memory_format)
 
-        with torch.no_grad():
+        with torch.inference_mode(), autocast():
             if y_condition:
-                y = y.to(device)
-                z, nll, y_logits = model(x, y)
+                y = y.to(device, non_blocking=True)
+                z, nll, y_logits = model_fn(x, y)
                 losses = compute_loss_y(
                     nll, y_logits, y_weight, y, multi_class, reduction="none"
                 )
+            elif loss_type == "nll":
+                z, nll, y_logits = model_fn(x, None)
+                losses = compute_loss(nll, reduction="none")
             else:
-                # z, nll, y_logits = model(x, None)
-                # losses = compute_loss(nll, reduction="none")
                 # TODO: WARNING: HACK: need to hard-code batch size in line 251 of model.py
-                x_pred = model(x=None, y_onehot=None, z=None, temperature=3e-1, reverse=True)
-                loss_energy = compute_loss_energy(x, x_pred, device=device, reduction="mean")
+                x_pred = model_fn(x=None, y_onehot=None, z=None, temperature=3e-1, reverse=True)
+                loss_energy = fp32_loss_energy(x, x_pred, reduction="mean")
                 loss_energy = loss_energy.view([1])
                 losses = {"total_loss": loss_energy, "loss_energy": loss_energy}
 
@@ -318,24 +455,20 @@ def main(
     def init(engine):
         model.train()
 
-        init_batches = []
-        init_targets = []
-
+        # stream the init batches through the model one at a time instead of
+        # concatenating them, to keep peak memory at a single batch
         with torch.no_grad():
             for batch, target in islice(train_loader, None, n_init_batches):
-                init_batches.append(batch)
-                init_targets.append(target)
+                batch = batch.to(device, non_blocking=True, memory_format=memory_format)
 
-            init_batches = torch.cat(init_batches).to(device)
+                if y_condition:
+                    target = target.to(device, non_blocking=True)
+                else:
+                    target = None
 
-            assert init_batches.shape[0] == n_init_batches * batch_size
+                model.init_actnorm_streaming(batch, target)
 
-            if y_condition:
-                init_targets = torch.cat(init_targets).to(device)
-            else:
-                init_targets = None
-
-            model(init_batches, init_targets)
+        model.set_actnorm_init()
 
     @trainer.on(Events.EPOCH_COMPLETED)
     def evaluate(engine):
@@ -435,6 +568,15 @@ if __name__ == "__main__":
         "--y_condition", action="store_true", help="Train using class condition"
     )
 
+    parser.add_argument(
+        "--loss",
+        type=str,
+        default="energy",
+        choices=["energy", "nll"],
+        dest="loss_type",
+        help="Training loss without class condition: MMD energy on samples, or NLL",
+    )
+
     parser.add_argument(
         "--y_weight", type=float, default=0.01, help="Weight for class condition loss"
     )
@@ -442,8 +584,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "--max_grad_clip",
         type=float,
-        default=.5,
-        help="Max gradient value (clip above - for off)",
+        default=0,
+        help="Max gradient value (clip above - 0 for off)",
     )
 
     parser.add_argument(
@@ -454,7 +596,10 @@ if __name__ == "__main__":
     )
 
     parser.add_argument(
-        "--n_workers", type=int, default=6, help="number of data loading workers"
+        "--n_workers",
+        type=int,
+        default=None,
+        help="number of data loading workers (default: based on CPU count)",
     )
 
     parser.add_argument(
@@ -492,6 +637,27 @@ if __name__ == "__main__":
         "--no_cuda", action="store_false", dest="cuda", help="Disables cuda"
     )
 
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="Precision of the model forward pass (bf16/fp16 use autocast); the MMD energy loss is always computed in fp32",
+    )
+
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        dest="compile_model",
+        help="Compile the model and energy loss with torch.compile",
+    )
+
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="Use channels_last memory format for the model and inputs",
+    )
+
     parser.add_argument(
         "--output_dir",
         default="output/",